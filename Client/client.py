@@ -3,82 +3,78 @@
 # it's position and returns the coordinates.
 
 # Author: Dhruv Sirohi
-from aiortc import RTCPeerConnection, MediaStreamTrack, RTCSessionDescription, RTCIceCandidate
-from aiortc.contrib.media import MediaRelay
-from aiortc.contrib.signaling import TcpSocketSignaling
-from aiortc.rtcrtpreceiver import RemoteStreamTrack
+import os
+import sys
+# common.py is shared by the client and the server: it sits next to this script in
+# the Docker image and one directory up in the repository. It is imported first so
+# that start-up times include the imports below.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import markStartup, Profiler, Channel, UnixClientTransport
+
+import argparse
 import multiprocessing
 import asyncio
+import struct
 import time
 import cv2 as cv
 import numpy as np
 import pickle
 
-from aiortc.contrib.signaling import BYE
-from aiortc.mediastreams import MediaStreamError
-
+# aiortc is only needed by the networking side of the client, so it is
+# imported where it is used. This keeps the detector process (and tests)
+# free of its import cost.
 
 HOST = '127.0.0.1'
 IN_PORT = 8080
-relay = MediaRelay()
+SOCKET_PATH = '/tmp/ball_track.sock'
+# Must match the server's pre-negotiated data channels.
+FRAMES_CHANNEL_ID = 0
+ESTIMATES_CHANNEL_ID = 1
+FRAME_LIFETIME = 500
+WARMUP_TIMEOUT = 10
 canvas = np.zeros((400, 400, 3), dtype='uint8')
 #######################################################################################################################
 
 
-class FrameRecorder(MediaStreamTrack):
+def detectCircle(img):
     '''
-    Class meant for handling clients side o the media track.
-    Supposed to use servers side track.recv() to obtain the
-    next frame.
+    Find the ball in a single frame using the Hough Gradient method.
+    :param img: np.array (BGR frame)
+    :return: np.array (x, y) of the detected center, None if no circle was found
     '''
-    kind = "video"
-
-    def __init__(self, track=None):
-        super().__init__()
-        self.track = track
-
-    def recv(self):
-        frame = self.track.recv()
-        # arr = frame.to_ndarray(format="bgr24")
-        # return arr
-        return frame
-
-    def addTrack(self, track):
-        if not self.track:
-            self.track = track
-
-#######################################################################################################################
-
-
-async def consume_track(tr):
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    gray = cv.medianBlur(gray, 5)
+    est_center = cv.HoughCircles(gray, cv.HOUGH_GRADIENT, 3.5, minDist=30,
+                                 param1=50, param2=20, minRadius=16,
+                                 maxRadius=22)
+    if est_center is None:
+        return None
+    arr = np.around(est_center)
+    return arr[0, :][0][0:2]
+
+
+def warmUp():
     '''
-    Method meant for continuously receiving media sent over
-    Media Track.
-    :param tr: MediaStreamTrack
-    :return: frame (not implemented)
+    Run a detection on a dummy frame so that OpenCV's lazy initialisation
+    (thread pool, kernels, buffers) happens before the first real frame arrives.
+    :return: float, time taken in ms
     '''
-    while True:
-        try:
-            print(tr)
-            frame = await tr.recv()
-            print(frame)
-            print('frame received...')
-        except MediaStreamError:
-            print('[Failed to consume track]')
-            return
+    begin = time.perf_counter()
+    dummy = cv.circle(canvas.copy(), (200, 200), 20, (255, 0, 0), -1)
+    detectCircle(dummy)
+    return (time.perf_counter() - begin) * 1000
 
-#######################################################################################################################
 
-
-def findCircle(frames, estimates, lock, test=False):
+def findCircle(frames, estimates, lock, test=False, profile_dir=None, ready=None):
     '''
     Multiprocess that finds circle in the received frame(s).
     Uses Hough Gradient method to detect circles in the 2D numpy array.
     :param frames: multiprocessing.Queue
-                   Object that stores all the received frames
+                   Object that stores all the received frames as (frame id, frame)
 
     :param estimates: multiprocessing.Queue
-                      Object that stores the estimates calculated.
+                      Object that stores the estimates calculated as (frame id, center).
+                      Frames without a detected circle get no estimate.
 
     :param lock: multiprocessing.Lock
                  Object used to ensure integrity of data shared between processes
@@ -86,9 +82,27 @@ def findCircle(frames, estimates, lock, test=False):
     :param test: Boolean
                  For testing purposes.
 
+    :param profile_dir: str
+                        Directory for profiling output (None disables profiling)
+
+    :param ready: multiprocessing.Event
+                  If given, the detector is warmed up on a dummy frame and the event
+                  is set once it is ready for real frames.
+
     :return: If testing (test == True): return circle estimates as np arrays
                                  else : None
     '''
+    profiler = Profiler('detector', profile_dir).install()
+    if ready is not None:
+        print('[Detector warmed up in {:.1f} ms]'.format(warmUp()))
+        ready.set()
+    try:
+        return _findCircle(frames, estimates, lock, test)
+    finally:
+        profiler.stop()
+
+
+def _findCircle(frames, estimates, lock, test):
     print('[Starting circle search...]')
     while True:
         with lock:
@@ -98,42 +112,142 @@ def findCircle(frames, estimates, lock, test=False):
                     return estimates
                 continue
         with lock:
-            img = frames.get()
-        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-        gray = cv.medianBlur(gray, 5)
-        est_center = cv.HoughCircles(gray, cv.HOUGH_GRADIENT, 3.5, minDist=30,
-                                     param1=50, param2=20, minRadius=16,
-                                     maxRadius=22)
-        if est_center is None:
+            frame_id, img = frames.get()
+        center_pos = detectCircle(img)
+        if center_pos is None:
             continue
-        else:
-            arr = np.around(est_center)
-            center_pos = arr[0, :][0][0:2]
 
         with lock:
-            estimates.put(center_pos)
+            estimates.put((frame_id, center_pos))
 
 #######################################################################################################################
+# Transports
+#
+# The client side of the server's transports. serve(on_channel) calls
+# on_channel(frames, estimates) once the channels to the server exist and then runs
+# until the server leaves (both may be the same channel). Channels follow
+# RTCDataChannel semantics: send(bytes) and "message"/"close" events.
 
-async def run_answer(server, signaling, frames, xy, lock):
 
+class ReassemblingChannel(Channel):
+    '''
+    Wraps the unreliable frames channel and reassembles the fragments sent by the
+    server's FragmentingChannel, emitting a "message" per complete frame. Frames are
+    delivered newest-first: once a frame completes, older incomplete frames can no
+    longer be useful and are dropped, as are late fragments belonging to them.
     '''
-    Handle client network operations. Once signaling and negotiation is complete
-    RTCPeer Connection state is "connected" and data retrieval and transfer begins.
 
-    On reception: Data is converted from str to 2d numpy arrays using pickle module.
+    HEADER = struct.Struct('!IHH')
+    MAX_PENDING = 8
+
+    def __init__(self, channel):
+        super().__init__()
+        self.channel = channel
+        self.dropped = 0
+        self._pending = {}
+        self._last = -1
+        channel.on('open', lambda: self.emit('open'))
+        channel.on('message', self._on_fragment)
+        channel.on('close', self.close)
+
+    def send(self, data):
+        self.channel.send(data)
+
+    def _on_fragment(self, fragment):
+        message_id, index, count = self.HEADER.unpack_from(fragment)
+        if message_id <= self._last:
+            return
+        parts = self._pending.get(message_id)
+        if parts is None:
+            if len(self._pending) >= self.MAX_PENDING:
+                self._drop(min(self._pending))
+            parts = self._pending[message_id] = [None] * count
+        parts[index] = fragment[self.HEADER.size:]
+        if None in parts:
+            return
+        del self._pending[message_id]
+        for stale in [m for m in self._pending if m < message_id]:
+            self._drop(stale)
+        self._last = message_id
+        self.emit('message', b''.join(parts))
+
+    def _drop(self, message_id):
+        del self._pending[message_id]
+        self.dropped += 1
+
+    def close(self):
+        if self.readyState == 'closed':
+            return
+        super().close()
+        self.channel.close()
+
+
+class RTCTransport:
+    '''
+    Default transport: TCP socket signaling and the RTCDataChannel created by the server.
+    '''
+
+    def __init__(self, host=HOST, port=IN_PORT):
+        from aiortc import RTCPeerConnection
+        from aiortc.contrib.signaling import TcpSocketSignaling
+        self.signaling = TcpSocketSignaling(host, port)
+        self.server = RTCPeerConnection()
+
+    async def serve(self, on_channel):
+        from aiortc import RTCSessionDescription, RTCIceCandidate
+        from aiortc.contrib.signaling import BYE
+
+        await self.signaling.connect()
+        markStartup('signaling connected')
+
+        frames = self.server.createDataChannel("frames", negotiated=True, id=FRAMES_CHANNEL_ID,
+                                               ordered=False, maxPacketLifeTime=FRAME_LIFETIME)
+        estimates = self.server.createDataChannel("estimates", negotiated=True, id=ESTIMATES_CHANNEL_ID)
+        on_channel(ReassemblingChannel(frames), estimates)
+
+        while True:
+            obj = await self.signaling.receive()
+
+            if isinstance(obj, RTCSessionDescription):
+                await self.server.setRemoteDescription(obj)
+                print('[Creating answer...]')
+                if obj.type == "offer":
+                    # send answer
+                    ans = await self.server.createAnswer()
+                    print('[Answer prepared]')
+                    await self.server.setLocalDescription(ans)
+                    print('[Set Local Description]')
+                    await self.signaling.send(self.server.localDescription)
+                    print('[Answer sent]')
+            elif isinstance(obj, RTCIceCandidate):
+                await self.server.addIceCandidate(obj)
+            elif obj is BYE:
+                print("Exiting...")
+                break
+
+    async def close(self):
+        await self.signaling.close()
+        await self.server.close()
+
+
+#######################################################################################################################
+
+async def run_answer(transport, frames, xy, lock):
+
+    '''
+    Handle client network operations. Once the transport has a channel to the server
+    (for WebRTC: signaling and negotiation are complete) data retrieval and transfer begins.
+
+    On reception: Data is converted from str to a (frame id, 2d numpy array) pair using pickle module.
                   It is then send to the shared multiprocessing.Queue frames, which is used by
                   findCircle method to calculate center of the circle.
         transfer: Once the center is detected, it is added to the shared multiprocessing.Queue
-                  xy. This method then obtains the center and sends it through the data channel
-                  established by the server, after conversion using pickle.
-
-    :param server: RTCPeerConnection
-                   Object responsible for handling peer connection and firing events.
+                  xy. This method then obtains the center and sends it, tagged with the id of
+                  the frame it was detected in, through the estimates channel established by the
+                  server, after conversion using pickle.
 
-    :param signaling: TCPSocketSignaling
-                      Object for signaling to establish the connection and begin secure data
-                      transfer.
+    :param transport: RTCTransport, UnixClientTransport
+                      Object that connects to the server and provides the data channel.
 
     :param frames: multiprocessing.Queue
                    Object that stores all the received frames
@@ -147,23 +261,24 @@ async def run_answer(server, signaling, frames, xy, lock):
     :return: None
     '''
 
-    await signaling.connect()
+    def on_channel(channel, estimates):
 
-    @server.on("datachannel")
-    def on_datachannel(channel):
-        print('[On Data Channel]')
+        @channel.on("open")
+        def on_open():
+            print('[On Data Channel]')
 
         @channel.on("message")
         def on_message(message):
+            markStartup('first frame received')
             cv.waitKey(1)
-            frm = pickle.loads(message)
+            frame_id, frm = pickle.loads(message)
             cv.namedWindow('Bouncy Ball')
             cv.moveWindow('Bouncy Ball', 0, 500)
             cv.imshow('Bouncy Ball', frm)
             cv.waitKey(1)
             with lock:
-                frames.put(frm)
-            asyncio.ensure_future(send_center(channel, xy, lock))
+                frames.put((frame_id, frm))
+            asyncio.ensure_future(send_center(estimates, xy, lock))
 
     async def send_center(channel, xy, lock):
         '''
@@ -181,58 +296,69 @@ async def run_answer(server, signaling, frames, xy, lock):
             if xy.empty():
                 return
         with lock:
-            xy_coord = xy.get()
+            frame_id, xy_coord = xy.get()
         xy_arr = np.array(xy_coord)
-        channel.send(pickle.dumps(xy_arr))
-
+        channel.send(pickle.dumps((frame_id, xy_arr)))
+        markStartup('first estimate sent')
 
-    while True:
-        obj = await signaling.receive()
-
-        if isinstance(obj, RTCSessionDescription):
-            await server.setRemoteDescription(obj)
-            print('[Creating answer...]')
-            # await recorder.start()
-            if obj.type == "offer":
-                # send answer
-                ans = await server.createAnswer()
-                print('[Answer prepared]')
-                await server.setLocalDescription(ans)
-                print('[Set Local Description]')
-                # cv2.imshow('Try', ans)
-                await signaling.send(server.localDescription)
-                print('[Answer sent]')
-        elif isinstance(obj, RTCIceCandidate):
-            await server.addIceCandidate(obj)
-        elif obj is BYE:
-            print("Exiting...")
-            break
+    await transport.serve(on_channel)
 
 #######################################################################################################################
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bouncing ball detection client.')
+    parser.add_argument('--profile', nargs='?', const='profiles', default=None, metavar='DIR',
+                        help='collect cProfile and tracemalloc data per process into DIR '
+                             '(default: ./profiles); SIGUSR1 toggles collection')
+    parser.add_argument('--profile-interval', type=float, default=Profiler.SNAPSHOT_INTERVAL,
+                        metavar='SECONDS', help='seconds between tracemalloc snapshots')
+    parser.add_argument('--transport', choices=('rtc', 'unix'), default='rtc',
+                        help='rtc: WebRTC data channel (default), unix: Unix-domain socket '
+                             'to a server on the same host')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar='PATH',
+                        help=f'socket path for --transport unix (default: {SOCKET_PATH})')
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    inSignal = TcpSocketSignaling(HOST, IN_PORT)
-    serv = RTCPeerConnection()
-    receiver = FrameRecorder() #Unused
+    ARGS = parse_args()
+    markStartup('imports')
 
     # multiprocessing objects
     FRAME_QUEUE = multiprocessing.Queue()
     XY_QUEUE = multiprocessing.Queue()
     LOCK = multiprocessing.Lock()
-    loop = asyncio.get_event_loop()
-    process_a = multiprocessing.Process(target=findCircle, args=(FRAME_QUEUE, XY_QUEUE, LOCK))
+    DETECTOR_READY = multiprocessing.Event()
+
+    # Start the detector before importing aiortc so that it warms up while
+    # the networking side is still being set up.
+    process_a = multiprocessing.Process(target=findCircle, args=(FRAME_QUEUE, XY_QUEUE, LOCK),
+                                        kwargs={'profile_dir': ARGS.profile,
+                                                'ready': DETECTOR_READY})
     process_a.start()
+
+    if ARGS.transport == 'unix':
+        transport = UnixClientTransport(ARGS.socket)
+    else:
+        transport = RTCTransport()
+    markStartup('transport ready')
+    if DETECTOR_READY.wait(WARMUP_TIMEOUT):
+        markStartup('detector ready')
+    else:
+        print('[Detector not ready after {} s, continuing]'.format(WARMUP_TIMEOUT))
+    loop = asyncio.get_event_loop()
+    profiler = Profiler('client', ARGS.profile, ARGS.profile_interval).install()
     while True:
+        # every session is profiled, not only the first one
+        profiler.start()
         try:
             loop.run_until_complete(
-                run_answer(serv, inSignal, FRAME_QUEUE, XY_QUEUE, LOCK)
+                run_answer(transport, FRAME_QUEUE, XY_QUEUE, LOCK)
             )
         except KeyboardInterrupt:
             pass
         finally:
+            profiler.stop()
             process_a.join(timeout=1)
-            loop.run_until_complete(inSignal.close())
-            loop.run_until_complete(serv.close())
-
-
+            loop.run_until_complete(transport.close())
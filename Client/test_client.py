@@ -1,7 +1,7 @@
 import os
 import sys
 import unittest
-from multiprocessing import Lock, Value, Queue
+from multiprocessing import Event, Lock, Value, Queue
 from queue import Queue
 
 import numpy as np
@@ -33,7 +33,7 @@ class TestServer(unittest.TestCase):
     def test_noCircle(self):
         img = np.zeros((400, 400, 3), dtype='uint8')
         frames = Queue()
-        frames.put(img)
+        frames.put((0, img))
         est = Queue()
         lock = Lock()
 
@@ -44,12 +44,50 @@ class TestServer(unittest.TestCase):
         img = np.zeros((400, 400, 3), dtype='uint8')
         cv.circle(img, (100, 100), 18, (255, 0, 0), -1)
         frames = Queue()
-        frames.put(img)
+        frames.put((0, img))
         est = Queue()
         lock = Lock()
         self.assertEqual(client.findCircle(frames, est, lock, True).qsize(), 1,
                         'Method findCenter() should detect one circle of nearly the same ' +
                         'size as the ball.')
 
+    def test_missedDetection(self):
+        blank = np.zeros((400, 400, 3), dtype='uint8')
+        frames = Queue()
+        frames.put((0, blank))
+        for frame_id, x in ((1, 150), (2, 200)):
+            frames.put((frame_id, cv.circle(blank.copy(), (x, 100), 18, (255, 0, 0), -1)))
+        with NoStdStreams():
+            est = client.findCircle(frames, Queue(), Lock(), True)
+        estimates = [est.get() for _ in range(est.qsize())]
+        self.assertEqual([frame_id for frame_id, _ in estimates], [1, 2],
+                         'Estimates should keep the id of the frame they were detected in.')
+        self.assertTrue(np.allclose(estimates[0][1], (150, 100), atol=2))
+        self.assertTrue(np.allclose(estimates[1][1], (200, 100), atol=2))
+
+    def test_detectorWarmUp(self):
+        ready = Event()
+        with NoStdStreams():
+            client.findCircle(Queue(), Queue(), Lock(), True, ready=ready)
+        self.assertTrue(ready.is_set(), 'Detector should signal readiness after warming up.')
+
+    def test_reassembleFrames(self):
+        header = client.ReassemblingChannel.HEADER
+        inner = client.Channel()
+        channel = client.ReassemblingChannel(inner)
+        received = []
+        channel.on('message', received.append)
+
+        def fragment(message_id, index, count, payload):
+            inner.emit('message', header.pack(message_id, index, count) + payload)
+
+        fragment(0, 0, 2, b'lost')          # frame 0 never completes
+        fragment(1, 1, 2, b'-b')            # out of order
+        fragment(1, 0, 2, b'frame1')
+        fragment(0, 1, 2, b'late')          # late fragment of a dropped frame
+        fragment(2, 0, 1, b'frame2')
+        self.assertEqual(received, [b'frame1-b', b'frame2'])
+        self.assertEqual(channel.dropped, 1, 'Incomplete older frame should be dropped.')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,330 @@
+# Synthetic load generator for the calibration server.
+# Runs many Server sessions in this process, each with its own Unix-domain
+# socket, and one lightweight simulated client per session in a separate
+# process, so that client work does not count against the server. Reports
+# server-side throughput, per-client fairness, frame latency and event loop
+# lag as the number of clients grows.
+#
+# Simulated clients replace the Hough transform with the center of the
+# bounding box of the ball's pixels, and can add a synthetic processing delay
+# and estimate error.
+#
+# Usage:
+#   python loadgen.py --clients 1,10,50,100,200 --duration 5
+#   python loadgen.py --delay 20 --error 2
+
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+import numpy as np
+from multiprocessing import Value
+
+import server
+# server.py puts the repository root on sys.path
+from common import UnixClientTransport
+
+SETTLE_TIME = 0.5
+CONNECT_TIMEOUT = 10
+LAG_PROBE_INTERVAL = 0.01
+
+#######################################################################################################################
+
+
+class TimedBall(server.BouncingBall):
+    """
+    BouncingBall that records when each frame was produced. The index into
+    `produced` is the frame id the server sends the frame with.
+    """
+
+    def __init__(self, xpos=100, ypos=100, speed=1):
+        super().__init__(xpos, ypos, speed)
+        self.produced = []
+
+    def updatePos(self):
+        super().updatePos()
+        self.produced.append(time.perf_counter())
+
+
+class TimedTransport:
+    """
+    Wraps a server transport and records when each frame is handed to the frames
+    channel. Frames are sent in order starting from id 0, so the index into `sent`
+    is the frame id.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sent = []
+
+    async def serve(self, on_channel):
+
+        def timed_on_channel(frames, estimates):
+            send = frames.send
+
+            def timed_send(data):
+                self.sent.append(time.perf_counter())
+                send(data)
+
+            frames.send = timed_send
+            on_channel(frames, estimates)
+
+        await self.transport.serve(timed_on_channel)
+
+    async def close(self):
+        await self.transport.close()
+
+
+class EstimateCounter:
+    '''
+    Stands in for the server's center queues and only counts what is put.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def put(self, item):
+        self.count += 1
+
+
+def boxCenter(frame):
+    '''
+    Trivial detector: center of the bounding box of the ball's pixels, sampled
+    on every second pixel so that the simulated clients stay much cheaper than
+    the server. Exact to a pixel for the filled ball.
+    :param frame: np.array (BGR frame)
+    :return: np.array (x, y), None if the frame is empty
+    '''
+    sampled = frame[::2, ::2, 0]
+    cols = np.flatnonzero(sampled.any(axis=0))
+    rows = np.flatnonzero(sampled.any(axis=1))
+    if cols.size == 0:
+        return None
+    return np.array((cols[0] + cols[-1], rows[0] + rows[-1]), dtype=float)
+
+
+class SimulatedClient:
+    """
+    Lightweight client for one session. Estimates the center with boxCenter(),
+    optionally waits `delay` seconds (without blocking the event loop) and adds
+    Gaussian noise with a standard deviation of `error` pixels before answering.
+    Records (frame id, time.perf_counter()) for every frame received.
+    """
+
+    def __init__(self, delay=0.0, error=0.0):
+        self.delay = delay
+        self.error = error
+        self.received = []
+        self._rng = np.random.default_rng()
+
+    def on_channel(self, frames, estimates):
+
+        @frames.on('message')
+        def on_message(message):
+            frame_id, frame = pickle.loads(message)
+            self.received.append((frame_id, time.perf_counter()))
+            estimate = boxCenter(frame)
+            if estimate is None:
+                return
+            if self.error:
+                estimate = estimate + self._rng.normal(0, self.error, 2)
+            if self.delay:
+                asyncio.ensure_future(self._send_later(estimates, frame_id, estimate))
+            elif estimates.readyState == 'open':
+                estimates.send(pickle.dumps((frame_id, estimate)))
+
+    async def _send_later(self, estimates, frame_id, estimate):
+        await asyncio.sleep(self.delay)
+        if estimates.readyState == 'open':
+            estimates.send(pickle.dumps((frame_id, estimate)))
+
+
+def runClients(socket_dir, clients, delay, error, results):
+    '''
+    Entry point of the client process: runs one SimulatedClient per session socket
+    until the server closes them, then sends every client's received list.
+    :param socket_dir: str, directory of the session sockets
+    :param clients: int, number of sessions
+    :param delay: float, synthetic processing delay in seconds
+    :param error: float, synthetic estimate error in pixels
+    :param results: multiprocessing.connection.Connection
+    :return: None
+    '''
+
+    async def run():
+        simulated = [SimulatedClient(delay, error) for _ in range(clients)]
+        transports = [UnixClientTransport(os.path.join(socket_dir, f'{index}.sock'), wait=True)
+                      for index in range(clients)]
+        await asyncio.gather(*(transport.serve(client.on_channel)
+                               for transport, client in zip(transports, simulated)))
+        return [client.received for client in simulated]
+
+    # Like the server sessions, the clients' connection messages are not part of the report.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        received = asyncio.run(run())
+    results.send(received)
+    results.close()
+
+#######################################################################################################################
+
+
+class Session:
+    '''
+    One Server serving its simulated client on <socket_dir>/<index>.sock.
+    '''
+
+    def __init__(self, index, socket_dir):
+        self.ball = TimedBall(100 + index % 200, 100 + (index * 7) % 200, 2)
+        self.estimates = EstimateCounter()
+        self.transport = TimedTransport(server.UnixTransport(os.path.join(socket_dir, f'{index}.sock')))
+        self.server = server.Server(self.transport)
+
+    def run(self, lock):
+        return self.server.run(self.ball, lock, EstimateCounter(), self.estimates)
+
+    def counters(self):
+        return len(self.transport.sent), self.estimates.count
+
+
+async def probeLag(lags):
+    '''
+    Measure event loop lag: how late a LAG_PROBE_INTERVAL sleep wakes up.
+    :param lags: list the lags (in seconds) are appended to
+    :return: None
+    '''
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        lags.append(loop.time() - start - LAG_PROBE_INTERVAL)
+
+
+def jainIndex(values):
+    '''
+    Jain's fairness index: 1.0 when every client got the same share, 1/n when one
+    client got everything.
+    '''
+    total = sum(values)
+    squares = sum(v * v for v in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+
+async def runStep(clients, duration, delay=0.0, error=0.0):
+    '''
+    Run `clients` sessions concurrently for `duration` seconds (after all of them
+    are connected and SETTLE_TIME seconds have passed) and measure them. The
+    simulated clients run in a separate process.
+    :return: dict of results
+    '''
+    server.GRAPHICS = Value('i')
+    server.CONNECTED = Value('i')
+    lock = threading.Lock()
+    # spawn: this process already runs threads and an event loop
+    context = multiprocessing.get_context('spawn')
+    results, client_results = context.Pipe(duplex=False)
+
+    with tempfile.TemporaryDirectory() as socket_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        sessions = [Session(i, socket_dir) for i in range(clients)]
+        running = asyncio.gather(*(session.run(lock) for session in sessions))
+        client_process = context.Process(target=runClients, daemon=True,
+                                         args=(socket_dir, clients, delay, error, client_results))
+        client_process.start()
+        client_results.close()
+
+        deadline = time.perf_counter() + CONNECT_TIMEOUT
+        while not all(session.transport.sent for session in sessions):
+            if time.perf_counter() > deadline or not client_process.is_alive():
+                raise RuntimeError('Simulated clients did not connect')
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(SETTLE_TIME)
+        lags = []
+        probe = asyncio.ensure_future(probeLag(lags))
+        before = [session.counters() for session in sessions]
+        start = time.perf_counter()
+        await asyncio.sleep(duration)
+        after = [session.counters() for session in sessions]
+        end = time.perf_counter()
+        probe.cancel()
+
+        for session in sessions:
+            await session.server.close()
+        await running
+        received = results.recv()
+        client_process.join()
+
+    elapsed = end - start
+    sent = [a[0] - b[0] for a, b in zip(after, before)]
+    estimates = [a[1] - b[1] for a, b in zip(after, before)]
+    # frame id -> (produced, sent, received) of the frames produced during the step
+    timings = np.array([(session.ball.produced[frame_id], session.transport.sent[frame_id], t)
+                        for session, frames in zip(sessions, received)
+                        for frame_id, t in frames
+                        if start <= session.ball.produced[frame_id] < end]).reshape(-1, 3)
+    latencies = timings[:, 2] - timings[:, 0]
+    send_latencies = timings[:, 2] - timings[:, 1]
+    per_client = [count / elapsed for count in estimates]
+    return {
+        'clients': clients,
+        'frames_per_s': sum(sent) / elapsed,
+        'target_per_s': clients / server.FRAME_INTERVAL,
+        'estimates_per_s': sum(estimates) / elapsed,
+        'fairness': jainIndex(estimates),
+        'min_client_per_s': min(per_client),
+        'max_client_per_s': max(per_client),
+        'latency_p50_ms': np.percentile(latencies, 50) * 1000 if latencies.size else float('nan'),
+        'latency_p99_ms': np.percentile(latencies, 99) * 1000 if latencies.size else float('nan'),
+        'send_latency_p50_ms': np.percentile(send_latencies, 50) * 1000 if latencies.size else float('nan'),
+        'send_latency_p99_ms': np.percentile(send_latencies, 99) * 1000 if latencies.size else float('nan'),
+        'loop_lag_p99_ms': np.percentile(lags, 99) * 1000 if lags else float('nan'),
+    }
+
+
+REPORT_FORMAT = '{:>8} {:>10} {:>10} {:>11} {:>9} {:>14} {:>9} {:>9} {:>9} {:>9} {:>9}'
+
+
+def printResult(result):
+    print(REPORT_FORMAT.format(result['clients'],
+                               '{:.0f}'.format(result['frames_per_s']),
+                               '{:.0f}'.format(result['target_per_s']),
+                               '{:.0f}'.format(result['estimates_per_s']),
+                               '{:.3f}'.format(result['fairness']),
+                               '{:.1f}-{:.1f}'.format(result['min_client_per_s'],
+                                                      result['max_client_per_s']),
+                               '{:.1f}'.format(result['latency_p50_ms']),
+                               '{:.1f}'.format(result['latency_p99_ms']),
+                               '{:.1f}'.format(result['send_latency_p50_ms']),
+                               '{:.1f}'.format(result['send_latency_p99_ms']),
+                               '{:.1f}'.format(result['loop_lag_p99_ms'])))
+
+#######################################################################################################################
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic client load generator for the calibration server.')
+    parser.add_argument('--clients', default='1,10,50,100,200', metavar='N[,N...]',
+                        help='comma separated client counts to ramp through')
+    parser.add_argument('--duration', type=float, default=5, metavar='SECONDS',
+                        help='measurement time per step')
+    parser.add_argument('--delay', type=float, default=0, metavar='MS',
+                        help='synthetic client processing delay per frame')
+    parser.add_argument('--error', type=float, default=0, metavar='PX',
+                        help='standard deviation of synthetic estimate error')
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    print(REPORT_FORMAT.format('clients', 'frames/s', 'target/s', 'estimates/s',
+                               'fairness', 'per-client/s', 'p50 ms', 'p99 ms', 'send p50', 'send p99',
+                               'lag ms'))
+    for clients in (int(n) for n in args.clients.split(',')):
+        printResult(await runStep(clients, args.duration, args.delay / 1000, args.error))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -8,29 +8,43 @@
 #
 # Author: Dhruv Sirohi
 
-import asyncio
 import os
+import sys
+# common.py is shared by the server and the client: it sits next to this script in
+# the Docker image and one directory up in the repository. It is imported first so
+# that start-up times include the imports below.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import markStartup, Profiler, Channel, StreamChannel
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import stat
+import struct
+import time
 import numpy as np
 import cv2 as cv
 import pickle
-import sys
-import keyboard
-import time
-from aiortc import RTCPeerConnection, MediaStreamTrack, RTCSessionDescription, RTCIceCandidate
-from aiortc.contrib.media import MediaRelay
-from aiortc.contrib.signaling import TcpSocketSignaling, BYE
-from aiortc.mediastreams import MediaStreamError
 from numpy import random
 from multiprocessing import Process, Queue, Value, Lock
 
 HOST = '127.0.0.1'
 OUT_PORT = 8080
+SOCKET_PATH = '/tmp/ball_track.sock'
+FRAME_INTERVAL = 0.05
+
+# WebRTC data channels are pre-negotiated on both sides with these ids. Frames go
+# over an unordered channel whose messages are abandoned after FRAME_LIFETIME ms,
+# estimates over a reliable, ordered one.
+FRAMES_CHANNEL_ID = 0
+ESTIMATES_CHANNEL_ID = 1
+FRAME_LIFETIME = 500
 
 TEXT_FONT = cv.FONT_HERSHEY_SIMPLEX
 FONT_SCALE = 1
 FONT_COLOR = (255, 255, 255)
 LINE_TYPE = 2
-relay = MediaRelay()
 
 COLORS = {
     "blue": (255, 0, 0),
@@ -140,8 +154,10 @@ class BouncingBall:
 
 
 #######################################################################################################################
+
+
 def calculateError(total_error, actual_centers, received_centers,
-                   lock, connection, graphics, test=False):
+                   lock, connection, graphics, test=False, profile_dir=None):
     """
     Used as a multiprocess. Works with multiprocess.Queue(s) to continuously
     calculate error as each estimated center is received. Calculates both
@@ -168,7 +184,19 @@ def calculateError(total_error, actual_centers, received_centers,
 
     :param test: Boolean
                  For testing purposes
+
+    :param profile_dir: str
+                        Directory for profiling output (None disables profiling)
     """
+    profiler = Profiler('error', profile_dir).install()
+    try:
+        return _calculateError(total_error, actual_centers, received_centers,
+                               lock, graphics, test)
+    finally:
+        profiler.stop()
+
+
+def _calculateError(total_error, actual_centers, received_centers, lock, graphics, test):
     toterr = 0
     while True:
 
@@ -234,87 +262,119 @@ def calculateError(total_error, actual_centers, received_centers,
 
 
 #######################################################################################################################
+# Transports
+#
+# A transport carries frames and estimates between server and client.
+# serve(on_channel) calls on_channel(frames, estimates) as soon as the channels exist
+# and then runs until the peer leaves; transports without head-of-line blocking may
+# pass the same channel twice. Every channel follows the RTCDataChannel semantics used
+# by the rest of the code: send(bytes), a readyState and "open", "message" and "close"
+# events registered with channel.on(...).
 
-class Server:
 
+class LocalChannel(Channel):
     '''
-    Class that handles server operations. Initiates socket and peer connection. Waits for
-    client to connect, creates a data channel, creates the offer, sets Local description and
-    sends the offer to client. Data transfer begins upon reception of answer and completion
-    of negotiation.
+    One end of an in-process channel. Messages are handed to the peer by reference
+    on the next event loop iteration; nothing is copied. Closing reaches the peer
+    after the messages already sent, and messages arriving after this end was
+    closed are dropped.
     '''
 
     def __init__(self):
-        self.host = HOST
-        self.port = OUT_PORT
-        self.signaling = TcpSocketSignaling(self.host, self.port)
-        self.cli = None
+        super().__init__()
+        self.peer = None
 
-    async def run(self, ball, lock=None, actual_centers=None, received_centers=None):
-        """
-            Used as a multiprocess. Works with multiprocess.Queue(s) to continuously
-            calculate error as each estimated center is received. Calculates both
-            frame-wise error and cumulative error. Uses Lock object to ensure data shared
-            between processes is not corrupted (i.e. waits for Queue(s) to receive input.
+    def send(self, data):
+        if self.readyState != 'open':
+            raise ConnectionError('Channel is not open')
+        asyncio.get_event_loop().call_soon(self.peer._receive, data)
 
-            :param ball: BouncingBall
-                         Object that handles ball operations and is used to update frame.
+    def _receive(self, data):
+        if self.readyState == 'open':
+            self.emit('message', data)
 
-            :param lock: multiprocessing.Lock
-                         Lock object to ensure data shared between processes doesn't get corrupted
+    def close(self):
+        if self.readyState == 'closed':
+            return
+        super().close()
+        if self.peer is not None:
+            asyncio.get_event_loop().call_soon(self.peer.close)
 
-            :param actual_centers: multiprocessing.Queue
-                                   Object that stores real circle centers of frames sent
 
-            :param received_centers: multiprocessing.Queue
-                                     Object that stores client-estimated circle centers of frames received
-            """
-        await self.signaling.connect()
+class FragmentingChannel(Channel):
+    '''
+    Wraps the unreliable frames channel and sends every message as fragments of at
+    most FRAGMENT_SIZE bytes, each prefixed with (message id, index, count). A lost
+    fragment then costs a single frame, which the client drops, rather than a
+    retransmission stall; the client reassembles the rest.
+    '''
 
-        print(f'[Server started...]')
-        self.cli = RTCPeerConnection()
+    HEADER = struct.Struct('!IHH')
+    FRAGMENT_SIZE = 16 * 1024
+    MAX_BUFFERED = 512 * 1024
+
+    def __init__(self, channel):
+        super().__init__()
+        self.channel = channel
+        self.dropped = 0
+        self._message_id = 0
+        channel.on('open', lambda: self.emit('open'))
+        channel.on('close', self.close)
+
+    def send(self, data):
+        # SCTP never abandons data that has not been sent yet, so on a slow link the
+        # send buffer (and latency) would grow without bound. Skip the frame instead.
+        if self.channel.bufferedAmount > self.MAX_BUFFERED:
+            self.dropped += 1
+            return
+        view = memoryview(data)
+        count = max(1, -(-len(view) // self.FRAGMENT_SIZE))
+        for index in range(count):
+            chunk = view[index * self.FRAGMENT_SIZE:(index + 1) * self.FRAGMENT_SIZE]
+            self.channel.send(self.HEADER.pack(self._message_id, index, count) + chunk)
+        self._message_id = (self._message_id + 1) % 2 ** 32
+
+    def close(self):
+        if self.readyState == 'closed':
+            return
+        super().close()
+        self.channel.close()
 
-        channel = self.cli.createDataChannel("frames")
 
-        async def send_frames(ball):
-            '''
-            Continuously send frames of bouncing ball once signaling and negotiation are complete.
-            :param ball: BouncingBall
-            :return: None
-            '''
-            print(f"Peer Connection State: {self.cli.connectionState}")
-            if GRAPHICS.value == -1:
-                print('\n')
-                print("{:<15} {:<15} {:<20} {:<20}".format('Actual Center', 'Est Center', 'Error', 'Cumulative Error'))
-            while True:
-                blank = np.zeros((200, 200, 3), dtype='uint8')
-                ball.updatePos()
-                frm = ball.getFrame()
-                center_pos = ball.getPos()
-                with lock:
-                    actual_centers.put(center_pos)
-                string = pickle.dumps(frm)
-                channel.send(string)
-                await asyncio.sleep(0.05)
+class RTCTransport:
+    '''
+    Default transport: TCP socket signaling and an RTCDataChannel. Waits for the
+    client to connect, creates the data channel, creates the offer, sets the local
+    description and sends the offer to client.
+    '''
 
-        @channel.on("open")
-        async def on_open():
-            asyncio.ensure_future(send_frames(ball))
+    def __init__(self, host=HOST, port=OUT_PORT):
+        # aiortc is only needed by this transport, keep it out of module import
+        # (and therefore out of the error process and tests).
+        from aiortc.contrib.signaling import TcpSocketSignaling
+        self.signaling = TcpSocketSignaling(host, port)
+        self.cli = None
 
+    async def serve(self, on_channel):
+        from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceCandidate
+        from aiortc.contrib.signaling import BYE
 
-        @channel.on("message")
-        def on_message(message):
-            center_pos = pickle.loads(message)
-            with lock:
-                received_centers.put(center_pos)
+        await self.signaling.connect()
+        markStartup('signaling connected')
+
+        print(f'[Server started...]')
+        self.cli = RTCPeerConnection()
 
+        frames = self.cli.createDataChannel("frames", negotiated=True, id=FRAMES_CHANNEL_ID,
+                                            ordered=False, maxPacketLifeTime=FRAME_LIFETIME)
+        estimates = self.cli.createDataChannel("estimates", negotiated=True, id=ESTIMATES_CHANNEL_ID)
+        on_channel(FragmentingChannel(frames), estimates)
 
         @self.cli.on("connectionstatechange")
         async def on_connectionstatechange():
+            print(f"Peer Connection State: {self.cli.connectionState}")
             if self.cli.connectionState == "failed":
                 await self.cli.close()
-                with lock:
-                    CONNECTED.value = -1
                 print('[CONNECTION LOST/CLOSED]')
 
         await self.cli.setLocalDescription(await self.cli.createOffer())
@@ -325,8 +385,6 @@ class Server:
         while True:
             obj = await self.signaling.receive()
             if isinstance(obj, RTCSessionDescription):
-                # with lock:
-                #     CONNECTED.value = 1
                 print(f'[Received answer]')
                 await self.cli.setRemoteDescription(obj)
                 print('[Set Remote description]')
@@ -334,33 +392,278 @@ class Server:
                 print(f'[Adding RTCIce Candidate...]')
                 await self.cli.addIceCandidate(obj)
             elif obj is BYE:
-                # cli.close()
-                with lock:
-                    CONNECTED.value = -1
                 print('Exiting...')
                 break
             elif self.cli.connectionState in ('closed', 'failed'):
                 return
 
-
     async def close(self):
         '''
         Close all connections.
         :return: None
         '''
-        if self.cli.connectionState != 'closed':
+        if self.cli and self.cli.connectionState != 'closed':
             print('[Closing peer connection]')
             await self.cli.close()
             print('[RTC Peer Connection closed]')
         if self.signaling:
             await self.signaling.close()
             print('[Socket offline]')
-            return
+
+
+class UnixTransport:
+    '''
+    Same-host transport over a Unix-domain socket. Skips DTLS/SCTP/ICE entirely;
+    serves a single client, like the WebRTC transport.
+    '''
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self._server = None
+        self._channel = None
+
+    async def serve(self, on_channel):
+        connected = asyncio.get_event_loop().create_future()
+
+        def on_connect(reader, writer):
+            if connected.done():
+                writer.close()
+                return
+            connected.set_result((reader, writer))
+
+        self._remove_stale_socket()
+        self._server = await asyncio.start_unix_server(on_connect, path=self.path)
+        print(f'[Server listening on {self.path}]')
+
+        reader, writer = await connected
+        markStartup('peer connected')
+        self._channel = StreamChannel(reader, writer)
+        on_channel(self._channel, self._channel)
+        self._channel.emit('open')
+        await self._channel.receive_forever()
+        print('Exiting...')
+
+    def _remove_stale_socket(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def close(self):
+        if self._channel:
+            self._channel.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._remove_stale_socket()
+            print('[Socket offline]')
+
+
+class LocalTransport:
+    '''
+    In-process transport for running server and client on the same event loop
+    (co-located calibration, benchmarks, tests). Create both ends with pair() and
+    pass one to Server and the other to the client.
+    '''
+
+    def __init__(self):
+        self.peer = None
+        self.channel = None
+
+    @classmethod
+    def pair(cls):
+        first, second = cls(), cls()
+        first.peer, second.peer = second, first
+        return first, second
+
+    async def serve(self, on_channel):
+        self.channel = LocalChannel()
+        on_channel(self.channel, self.channel)
+        if self.peer.channel is not None:
+            self.channel.peer, self.peer.channel.peer = self.peer.channel, self.channel
+            self.peer.channel.emit('open')
+            self.channel.emit('open')
+        await self.channel.wait_closed()
+
+    async def close(self):
+        if self.channel:
+            self.channel.close()
 
 #######################################################################################################################
 
 
+class FrameProducer:
+    """
+    Producer stage of the frame pipeline. Advances the ball, renders and pickles
+    a frame on a worker thread when the sender asks for it, so that the event loop
+    does not run that work itself and frames are not kept waiting in a buffer:
+    the frame sent is the state of the ball when the frame was requested.
+
+    All producers share a single worker thread: it runs each producer's jobs in
+    order, and several sessions in one process do not add threads competing with
+    the event loop for the GIL. Jobs are profiled with `profiler`, if given.
+    """
+
+    # Seconds before its send deadline that a frame is requested; producing one
+    # takes well under a millisecond.
+    LEAD = 0.005
+    _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='frame-producer')
+
+    def __init__(self, ball, profiler=None):
+        self.ball = ball
+        self.profiler = profiler if profiler is not None else Profiler('producer')
+        self._frame_id = 0
+
+    async def get(self):
+        '''
+        Produce the next frame. An exception raised while producing it is raised here.
+        :return: (frame id, actual center, pickled (frame id, frame))
+        '''
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._produce)
+
+    def _produce(self):
+        frame_id = self._frame_id
+        self._frame_id += 1
+        with self.profiler.thread():
+            self.ball.updatePos()
+            data = pickle.dumps((frame_id, self.ball.getFrame()))
+        return frame_id, self.ball.getPos(), data
+
+#######################################################################################################################
+
+class Server:
+
+    '''
+    Class that handles server operations. Waits for a client to connect through the
+    transport (WebRTC data channel by default) and, once the channel is open, sends
+    frames of the bouncing ball and collects the estimates sent back.
+
+    Frames are sent as (frame id, frame) and estimates come back as (frame id, center),
+    so that frames lost on the way can be skipped when pairing actual and estimated
+    centers for the error calculation. Frames are produced by a FrameProducer
+    shortly before they are due and sent every FRAME_INTERVAL seconds.
+    '''
+
+    MAX_IN_FLIGHT = 64
+
+    def __init__(self, transport=None, profiler=None):
+        self.transport = transport if transport is not None else RTCTransport()
+        self.profiler = profiler
+
+    async def run(self, ball, lock=None, actual_centers=None, received_centers=None):
+        """
+            Send frames of ball over the transport's frames channel and store the estimated
+            centers received until the client leaves.
+
+            :param ball: BouncingBall
+                         Object that handles ball operations and is used to update frame.
+
+            :param lock: multiprocessing.Lock
+                         Lock object to ensure data shared between processes doesn't get corrupted
+
+            :param actual_centers: multiprocessing.Queue
+                                   Object that stores real circle centers of frames an estimate was
+                                   received for
+
+            :param received_centers: multiprocessing.Queue
+                                     Object that stores client-estimated circle centers of frames received
+            """
+        # frame id -> actual center of frames still waiting for an estimate
+        in_flight = collections.OrderedDict()
+        producer = FrameProducer(ball, profiler=self.profiler)
+        senders = []
+
+        def on_channel(frames, estimates):
+
+            async def send_frames():
+                '''
+                Send frames at a steady rate while the channel is open. Sends are scheduled
+                against a deadline: each frame is requested FrameProducer.LEAD before it and
+                sent as soon as it is ready. If the loop falls behind by more than a frame,
+                the schedule is reset instead of sending a burst.
+                :return: None
+                '''
+                if GRAPHICS.value == -1:
+                    print('\n')
+                    print("{:<15} {:<15} {:<20} {:<20}".format('Actual Center', 'Est Center', 'Error', 'Cumulative Error'))
+                loop = asyncio.get_event_loop()
+                deadline = loop.time()
+                while frames.readyState == 'open':
+                    await asyncio.sleep(deadline - producer.LEAD - loop.time())
+                    frame_id, center_pos, string = await producer.get()
+                    if frames.readyState != 'open':
+                        break
+                    in_flight[frame_id] = center_pos
+                    if len(in_flight) > self.MAX_IN_FLIGHT:
+                        in_flight.popitem(last=False)
+                    frames.send(string)
+                    deadline = max(deadline + FRAME_INTERVAL, loop.time() - FRAME_INTERVAL)
+
+            @frames.on("open")
+            async def on_open():
+                markStartup('channel open')
+                senders.append(asyncio.ensure_future(send_frames()))
+
+            @estimates.on("message")
+            def on_message(message):
+                markStartup('first estimate received')
+                frame_id, center_pos = pickle.loads(message)
+                if frame_id not in in_flight:
+                    return
+                # Estimates arrive in order: older frames still in flight were lost.
+                while True:
+                    sent_id, actual_pos = in_flight.popitem(last=False)
+                    if sent_id == frame_id:
+                        break
+                with lock:
+                    actual_centers.put(actual_pos)
+                    received_centers.put(center_pos)
+
+            @frames.on("close")
+            def on_close():
+                with lock:
+                    CONNECTED.value = -1
+
+        try:
+            await self.transport.serve(on_channel)
+        finally:
+            # a sender may still be waiting on the producer
+            for sender in senders:
+                sender.cancel()
+        with lock:
+            CONNECTED.value = -1
+
+    async def close(self):
+        '''
+        Close all connections.
+        :return: None
+        '''
+        await self.transport.close()
+
+#######################################################################################################################
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Bouncing ball calibration server.')
+    parser.add_argument('--no-graphics', action='store_true',
+                        help='print the error report to the terminal instead of a window')
+    parser.add_argument('--profile', nargs='?', const='profiles', default=None, metavar='DIR',
+                        help='collect cProfile and tracemalloc data per process into DIR '
+                             '(default: ./profiles); SIGUSR1 toggles collection')
+    parser.add_argument('--profile-interval', type=float, default=Profiler.SNAPSHOT_INTERVAL,
+                        metavar='SECONDS', help='seconds between tracemalloc snapshots')
+    parser.add_argument('--transport', choices=('rtc', 'unix'), default='rtc',
+                        help='rtc: WebRTC data channel (default), unix: Unix-domain socket '
+                             'for a client on the same host')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar='PATH',
+                        help=f'socket path for --transport unix (default: {SOCKET_PATH})')
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    ARGS = parse_args()
+    markStartup('imports')
     print('[Starting server...]')
     CONNECTED = Value('i', lock=True)
     ROOT = os.path.dirname(__file__)
@@ -369,22 +672,25 @@ if __name__ == "__main__":
     TOTAL_ERROR = Value('d', lock=True)
     GRAPHICS = Value('i', lock = True)
     LOCK = Lock()
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '--no-graphics':
-            GRAPHICS.value = -1
-        else:
-            print('Invalid argument')
-            raise RuntimeError
-    server = Server()
+    if ARGS.no_graphics:
+        GRAPHICS.value = -1
+    # The frame producer thread is profiled along with the server's main thread.
+    profiler = Profiler('server', ARGS.profile, ARGS.profile_interval)
+    if ARGS.transport == 'unix':
+        server = Server(UnixTransport(ARGS.socket), profiler)
+    else:
+        server = Server(RTCTransport(), profiler)
     baller = BouncingBall(280, 60, 2)
 
     # Create branched process (multiprocess)
     error_process = Process(target=calculateError,
                             args=(TOTAL_ERROR, ACTUAL_CENTERS,
-                                  RECEIVED_CENTERS, LOCK, CONNECTED, GRAPHICS))
+                                  RECEIVED_CENTERS, LOCK, CONNECTED, GRAPHICS),
+                            kwargs={'profile_dir': ARGS.profile})
     loop = asyncio.get_event_loop()
     try:
         error_process.start()
+        profiler.install()
         loop.run_until_complete(
             server.run(baller, LOCK, ACTUAL_CENTERS, RECEIVED_CENTERS)
         )
@@ -392,6 +698,7 @@ if __name__ == "__main__":
         print('Exit due to keyboard interrupt')
     finally:
         print('[Closing processes and connections...]')
+        profiler.stop()
         error_process.join(timeout=1)
         error_process.terminate()
         print('[Multiprocess Terminated, now ensuring connections closed.]')
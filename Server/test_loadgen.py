@@ -0,0 +1,35 @@
+import asyncio
+import unittest
+
+import numpy as np
+import cv2 as cv
+
+from Server import loadgen
+
+
+class TestLoadgen(unittest.TestCase):
+
+    def test_boxCenter(self):
+        img = np.zeros((400, 400, 3), dtype='uint8')
+        cv.circle(img, (100, 150), 20, (255, 0, 0), -1)
+        self.assertTrue(np.allclose(loadgen.boxCenter(img), (100, 150)),
+                        'Bounding box center of a filled circle should be its center.')
+        self.assertIsNone(loadgen.boxCenter(np.zeros((400, 400, 3), dtype='uint8')))
+
+    def test_jainIndex(self):
+        self.assertEqual(loadgen.jainIndex([5, 5, 5, 5]), 1.0)
+        self.assertEqual(loadgen.jainIndex([8, 0, 0, 0]), 0.25)
+
+    def test_runStep(self):
+        result = asyncio.run(loadgen.runStep(3, 0.3, delay=0.01, error=1))
+        self.assertEqual(result['clients'], 3)
+        self.assertGreater(result['frames_per_s'], 0, 'Server should produce frames.')
+        self.assertGreater(result['estimates_per_s'], 0, 'Clients should answer.')
+        self.assertLessEqual(result['fairness'], 1.0)
+        self.assertGreater(result['latency_p50_ms'], 0, 'Latency should be measured.')
+        self.assertGreaterEqual(result['latency_p50_ms'], result['send_latency_p50_ms'],
+                                'Frames cannot arrive before they are sent.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
+import asyncio
+import pickle
+import pstats
 import sys
 import os
+import tempfile
 import unittest
 from multiprocessing import Lock, Value, Queue
 from queue import Queue
@@ -7,6 +11,7 @@ from queue import Queue
 import numpy as np
 
 from Server import server
+from common import UnixClientTransport
 
 
 class NoStdStreams(object):
@@ -28,6 +33,27 @@ class NoStdStreams(object):
         sys.stderr = self.old_stderr
         self.devnull.close()
 
+class EchoClient:
+    '''
+    Stand-in for the client: answers every frame with a fixed estimate and
+    leaves after a number of frames.
+    '''
+    def __init__(self, frames=3, lost=()):
+        self.frames = frames
+        self.lost = lost
+        self.received = []
+
+    def on_channel(self, frames, estimates):
+        @frames.on('message')
+        def on_message(message):
+            frame_id, frame = pickle.loads(message)
+            self.received.append(frame)
+            if frame_id not in self.lost:
+                estimates.send(pickle.dumps((frame_id, np.array((0, 0)))))
+            if len(self.received) == self.frames:
+                frames.close()
+
+
 class TestServer(unittest.TestCase):
     def setUp(self):
         pass
@@ -76,6 +102,129 @@ class TestServer(unittest.TestCase):
         with NoStdStreams():
             self.assertEqual(0, toterr, 'Total Error should be zero for identical lists of coordinates.')
 
+    def test_profileProducer(self):
+        with tempfile.TemporaryDirectory() as out_dir, NoStdStreams():
+            profiler = server.Profiler('test', out_dir)
+            profiler.start()
+            producer = server.FrameProducer(server.BouncingBall(50, 50, 2), profiler=profiler)
+            asyncio.run(producer.get())
+            profiler.stop()
+            stats = pstats.Stats(os.path.join(out_dir, 'test-{}-1.prof'.format(os.getpid())))
+        self.assertIn('updatePos', [function for _, _, function in stats.stats],
+                      'Frames produced on the worker thread should be in the profile.')
+
+    def runSession(self, transport, client_session, profiler=None):
+        server.GRAPHICS = Value('i')
+        server.GRAPHICS.value = -1
+        server.CONNECTED = Value('i')
+        srv = server.Server(transport, profiler)
+        actual_pos = Queue()
+        est_pos = Queue()
+
+        async def session():
+            await asyncio.gather(srv.run(server.BouncingBall(50, 50, 2), Lock(), actual_pos, est_pos),
+                                 client_session)
+            await srv.close()
+
+        with NoStdStreams():
+            asyncio.run(session())
+        return actual_pos, est_pos
+
+    def test_localTransport(self):
+        server_end, client_end = server.LocalTransport.pair()
+        echo = EchoClient()
+        actual_pos, est_pos = self.runSession(server_end, client_end.serve(echo.on_channel))
+        self.assertEqual(len(echo.received), 3, 'Client should receive three frames.')
+        self.assertEqual(echo.received[0].shape, (400, 400, 3))
+        self.assertEqual(est_pos.qsize(), 3, 'Server should receive an estimate per frame.')
+        self.assertEqual(actual_pos.qsize(), 3, 'Each estimate should be paired with its frame.')
+        self.assertEqual(server.CONNECTED.value, -1, 'Connection should be marked as closed.')
+
+    def test_profiledSession(self):
+        # as with --profile: the profiler is collecting before the session starts
+        with tempfile.TemporaryDirectory() as out_dir:
+            profiler = server.Profiler('test', out_dir)
+            with NoStdStreams():
+                profiler.start()
+            server_end, client_end = server.LocalTransport.pair()
+            echo = EchoClient()
+            try:
+                self.runSession(server_end, client_end.serve(echo.on_channel), profiler)
+            finally:
+                with NoStdStreams():
+                    profiler.stop()
+            stats = pstats.Stats(os.path.join(out_dir, 'test-{}-1.prof'.format(os.getpid())))
+        self.assertEqual(len(echo.received), 3, 'Frames should flow while profiling.')
+        self.assertIn('updatePos', [function for _, _, function in stats.stats],
+                      'Frames produced on the worker thread should be in the profile.')
+
+    def test_lostFrame(self):
+        server_end, client_end = server.LocalTransport.pair()
+        echo = EchoClient(lost=(1,))
+        actual_pos, est_pos = self.runSession(server_end, client_end.serve(echo.on_channel))
+        self.assertEqual(est_pos.qsize(), 2)
+        self.assertEqual([tuple(actual_pos.get()) for _ in range(2)], [(52, 52), (56, 56)],
+                         'Estimates should be paired with the frames they were made for.')
+
+    def test_unixTransport(self):
+        echo = EchoClient()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ball.sock')
+            client_end = UnixClientTransport(path, wait=True)
+            actual_pos, est_pos = self.runSession(server.UnixTransport(path), client_end.serve(echo.on_channel))
+            self.assertFalse(os.path.exists(path), 'Socket should be removed on close.')
+        self.assertEqual(len(echo.received), 3, 'Client should receive three frames.')
+        self.assertEqual(est_pos.qsize(), 3, 'Server should receive an estimate per frame.')
+
+    def test_fragmentFrame(self):
+        sent = []
+        inner = server.Channel()
+        inner.send = sent.append
+        inner.bufferedAmount = 0
+        channel = server.FragmentingChannel(inner)
+        inner.emit('open')
+        self.assertEqual(channel.readyState, 'open', 'Wrapper should follow the inner channel.')
+
+        data = bytes(range(256)) * 200
+        channel.send(data)
+        channel.send(b'')
+        header = server.FragmentingChannel.HEADER
+        self.assertEqual(len(sent), 5, 'Expected four fragments and one empty message.')
+        self.assertEqual([header.unpack_from(f) for f in sent],
+                         [(0, 0, 4), (0, 1, 4), (0, 2, 4), (0, 3, 4), (1, 0, 1)])
+        self.assertEqual(b''.join(f[header.size:] for f in sent[:4]), data)
+
+        inner.bufferedAmount = channel.MAX_BUFFERED + 1
+        channel.send(data)
+        self.assertEqual(len(sent), 5, 'Frame should be skipped while the channel is backed up.')
+        self.assertEqual(channel.dropped, 1)
+
+    def test_frameProducer(self):
+        ball = server.BouncingBall(50, 50, 2)
+        producer = server.FrameProducer(ball)
+
+        async def consume():
+            items = [await producer.get() for _ in range(3)]
+            await asyncio.sleep(0.2)
+            return items
+
+        items = asyncio.run(consume())
+        self.assertEqual([item[0] for item in items], [0, 1, 2], 'Frames should be produced in order.')
+        self.assertEqual([tuple(item[1]) for item in items], [(52, 52), (54, 54), (56, 56)])
+        frame_id, frame = pickle.loads(items[2][2])
+        self.assertEqual(frame_id, 2)
+        self.assertEqual(frame.shape, (400, 400, 3))
+        self.assertEqual(tuple(ball.getPos()), (56, 56), 'Frames should only be produced when asked for.')
+
+    def test_frameProducerFailure(self):
+        class BrokenBall(server.BouncingBall):
+            def updatePos(self):
+                raise ValueError('broken ball')
+
+        producer = server.FrameProducer(BrokenBall(50, 50, 2))
+        with self.assertRaises(ValueError, msg='Failures on the worker thread should reach the consumer.'):
+            asyncio.run(asyncio.wait_for(producer.get(), 2))
+
 
 # def calculateError(total_error, actual_centers, received_centers, lock, connection):
 
@@ -0,0 +1,301 @@
+# Code shared by the server and the client: start-up timing, profiling and
+# the channels of the non-WebRTC transports.
+#
+# Author: Dhruv Sirohi
+
+import time
+# Reference for markStartup. The scripts import this module first, so start-up
+# times cover their imports, but not interpreter initialisation.
+START_TIME = time.perf_counter()
+
+import asyncio
+import contextlib
+import cProfile
+import os
+import pstats
+import signal
+import struct
+import sys
+import threading
+import tracemalloc
+
+_startup_marks = {}
+#######################################################################################################################
+
+
+def markStartup(event):
+    '''
+    Record and print the time elapsed between the import of this module and the
+    first occurrence of event. Later occurrences of the same event are ignored.
+    :param event: str
+    :return: None
+    '''
+    if event in _startup_marks:
+        return
+    elapsed = (time.perf_counter() - START_TIME) * 1000
+    _startup_marks[event] = elapsed
+    print('[Startup] {:<25} {:>10.1f} ms'.format(event, elapsed))
+
+#######################################################################################################################
+
+
+class Profiler:
+    """
+    On-demand CPU and allocation profiling for a single process.
+
+    While active, collects a cProfile profile of the process and takes a
+    tracemalloc snapshot every `interval` seconds. Results are written to
+    `out_dir` as <role>-<pid>-<session>.prof (load with pstats) and
+    <role>-<pid>-<session>-mem<n>.txt (top allocation sites).
+
+    A Profiler without an output directory is disabled and every method is a
+    no-op, so nothing is paid on the hot path when profiling is off. Once
+    installed, SIGUSR1 toggles collection at runtime; every stop dumps results.
+
+    cProfile only sees the thread it was started on. Work run on other threads
+    is profiled by wrapping it in thread(); it is merged into the same .prof.
+    """
+
+    SNAPSHOT_INTERVAL = 30
+    TOP_ALLOCATIONS = 25
+
+    def __init__(self, role, out_dir=None, interval=SNAPSHOT_INTERVAL):
+        self.role = role
+        self.out_dir = out_dir
+        self.interval = interval
+        self.active = False
+        self._lock = threading.RLock()
+        self._profile = None
+        self._thread_stats = None
+        self._timer = None
+        self._session = 0
+        self._snapshots = 0
+
+    @property
+    def enabled(self):
+        return self.out_dir is not None
+
+    def install(self):
+        '''
+        Register the SIGUSR1 toggle and a SIGTERM handler that unwinds the process
+        (so that results are dumped on terminate()), then start collecting.
+        :return: Profiler
+        '''
+        if not self.enabled:
+            return self
+        os.makedirs(self.out_dir, exist_ok=True)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+        self.start()
+        return self
+
+    def start(self):
+        with self._lock:
+            if not self.enabled or self.active:
+                return
+            self._session += 1
+            self._snapshots = 0
+            tracemalloc.start()
+            self._profile = cProfile.Profile()
+            self._thread_stats = None
+            self._profile.enable()
+            self.active = True
+            self._schedule_snapshot()
+        print(f'[Profiling {self.role} (pid {os.getpid()})]')
+
+    def stop(self):
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            self._timer.cancel()
+            self._profile.disable()
+            stats = pstats.Stats(self._profile)
+            if self._thread_stats is not None:
+                stats.add(self._thread_stats)
+            stats.dump_stats(self._path('.prof'))
+            self._snapshot()
+            tracemalloc.stop()
+        print(f'[Profile of {self.role} written to {self.out_dir}]')
+
+    def toggle(self):
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    @contextlib.contextmanager
+    def thread(self):
+        '''
+        Profile the enclosed work, run on any thread, as part of the current session.
+        Work still running when the session stops is left out.
+        :return: context manager
+        '''
+        # From Python 3.12 cProfile is built on sys.monitoring: the session's profile
+        # already sees every thread, and a second one cannot be enabled.
+        if not self.active or sys.version_info >= (3, 12):
+            yield
+            return
+        session = self._session
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                if self.active and self._session == session:
+                    if self._thread_stats is None:
+                        self._thread_stats = pstats.Stats(profile)
+                    else:
+                        self._thread_stats.add(profile)
+
+    def _path(self, suffix):
+        name = f'{self.role}-{os.getpid()}-{self._session}{suffix}'
+        return os.path.join(self.out_dir, name)
+
+    def _snapshot(self):
+        self._snapshots += 1
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        with open(self._path(f'-mem{self._snapshots}.txt'), 'w') as out:
+            for stat in stats[:self.TOP_ALLOCATIONS]:
+                out.write(f'{stat}\n')
+
+    def _schedule_snapshot(self):
+        self._timer = threading.Timer(self.interval, self._periodic_snapshot)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _periodic_snapshot(self):
+        with self._lock:
+            if not self.active:
+                return
+            self._snapshot()
+            self._schedule_snapshot()
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(0)
+
+#######################################################################################################################
+# Channels
+#
+# Every channel follows the RTCDataChannel semantics used by the server and the
+# client: send(bytes), a readyState and "open", "message" and "close" events
+# registered with channel.on(...).
+
+
+class Channel:
+    '''
+    Minimal RTCDataChannel look-alike used by the non-WebRTC transports: event
+    handling and the connection state. Subclasses provide send(data).
+    Handlers may be plain functions or coroutine functions (which are scheduled).
+    '''
+
+    def __init__(self):
+        self.readyState = 'connecting'
+        self._handlers = {}
+        self._closed = asyncio.Event()
+
+    def on(self, event, handler=None):
+        def register(handler):
+            self._handlers.setdefault(event, []).append(handler)
+            return handler
+        return register(handler) if handler else register
+
+    def emit(self, event, *args):
+        if event == 'open':
+            self.readyState = 'open'
+        for handler in self._handlers.get(event, []):
+            result = handler(*args)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+
+    def close(self):
+        if self.readyState == 'closed':
+            return
+        self.readyState = 'closed'
+        self._closed.set()
+        self.emit('close')
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+
+class StreamChannel(Channel):
+    '''
+    Channel over an asyncio stream (e.g. a Unix-domain socket). Each message is
+    framed with a 4 byte big-endian length prefix. While more than MAX_BUFFERED
+    bytes are waiting to be written, new messages are skipped and counted in
+    `dropped`, so that a slow peer cannot make the write buffer grow without bound.
+    '''
+
+    HEADER = struct.Struct('!I')
+    MAX_BUFFERED = 512 * 1024
+
+    def __init__(self, reader, writer):
+        super().__init__()
+        self._reader = reader
+        self._writer = writer
+        self.dropped = 0
+
+    def send(self, data):
+        if self.readyState != 'open':
+            raise ConnectionError('Channel is not open')
+        if self._writer.transport.get_write_buffer_size() > self.MAX_BUFFERED:
+            self.dropped += 1
+            return
+        self._writer.write(self.HEADER.pack(len(data)))
+        self._writer.write(data)
+
+    async def receive_forever(self):
+        '''
+        Emit a "message" event for every frame read until the peer disconnects.
+        :return: None
+        '''
+        try:
+            while True:
+                header = await self._reader.readexactly(self.HEADER.size)
+                (size,) = self.HEADER.unpack(header)
+                self.emit('message', await self._reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.readyState != 'closed':
+            self._writer.close()
+        super().close()
+
+
+class UnixClientTransport:
+    '''
+    Client side of the server's Unix-domain socket transport (server.UnixTransport).
+    '''
+
+    def __init__(self, path, wait=False):
+        '''
+        :param path: str, socket path the server listens on
+        :param wait: bool, wait for the server to create the socket instead of failing
+                     when it does not exist yet
+        '''
+        self.path = path
+        self.wait = wait
+        self._channel = None
+
+    async def serve(self, on_channel):
+        while self.wait and not os.path.exists(self.path):
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        markStartup('peer connected')
+        self._channel = StreamChannel(reader, writer)
+        on_channel(self._channel, self._channel)
+        self._channel.emit('open')
+        await self._channel.receive_forever()
+        print('Exiting...')
+
+    async def close(self):
+        if self._channel:
+            self._channel.close()
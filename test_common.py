@@ -0,0 +1,136 @@
+import asyncio
+import os
+import pickle
+import signal
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import common
+
+
+class NoStdStreams(object):
+    def __init__(self, stdout = None, stderr=None):
+        self.devnull = open(os.devnull, 'w')
+        self._stdout = stdout or self.devnull or sys.stdout
+        self._stderr = stderr or self.devnull or sys.stderr
+
+    def __enter__(self):
+        self.old_stdout, self.old_stderr = sys.stdout, sys.stderr
+        self.old_stdout.flush()
+        self.old_stderr.flush()
+        sys.stdout, sys.stderr = self._stdout, self._stderr
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stdout.flush()
+        self._stderr.flush()
+        sys.stdout = self.old_stdout
+        sys.stderr = self.old_stderr
+        self.devnull.close()
+
+
+def waitFor(condition, timeout=2):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestCommon(unittest.TestCase):
+
+    def test_profilerDisabled(self):
+        profiler = common.Profiler('test')
+        profiler.start()
+        self.assertFalse(profiler.active, 'Profiler without an output directory should stay off.')
+
+    def test_profilerDump(self):
+        with tempfile.TemporaryDirectory() as out_dir, NoStdStreams():
+            profiler = common.Profiler('test', out_dir)
+            profiler.toggle()
+            np.zeros((400, 400, 3), dtype='uint8')
+            profiler.toggle()
+            self.assertEqual(sorted(os.listdir(out_dir)),
+                             ['test-{}-1-mem1.txt'.format(os.getpid()),
+                              'test-{}-1.prof'.format(os.getpid())])
+
+    def test_profilerSignal(self):
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGUSR1, signal.SIGTERM)}
+        try:
+            with tempfile.TemporaryDirectory() as out_dir, NoStdStreams():
+                profiler = common.Profiler('test', out_dir).install()
+                self.assertTrue(profiler.active, 'Installed profiler should start collecting.')
+                os.kill(os.getpid(), signal.SIGUSR1)
+                self.assertTrue(waitFor(lambda: not profiler.active), 'SIGUSR1 should stop collection.')
+                self.assertIn('test-{}-1.prof'.format(os.getpid()), os.listdir(out_dir))
+                os.kill(os.getpid(), signal.SIGUSR1)
+                self.assertTrue(waitFor(lambda: profiler.active), 'SIGUSR1 should resume collection.')
+                profiler.stop()
+                self.assertIn('test-{}-2.prof'.format(os.getpid()), os.listdir(out_dir),
+                              'Each collection session should be dumped separately.')
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def test_profilerSnapshots(self):
+        with tempfile.TemporaryDirectory() as out_dir, NoStdStreams():
+            profiler = common.Profiler('test', out_dir, interval=0.05)
+            profiler.start()
+            snapshot = 'test-{}-1-mem2.txt'.format(os.getpid())
+            self.assertTrue(waitFor(lambda: snapshot in os.listdir(out_dir)),
+                            'Snapshots should be taken every interval while active.')
+            profiler.stop()
+            taken = len([name for name in os.listdir(out_dir) if '-mem' in name])
+            time.sleep(0.2)
+            self.assertEqual(len([name for name in os.listdir(out_dir) if '-mem' in name]), taken,
+                             'No snapshots should be taken once stopped.')
+
+    def test_streamChannel(self):
+        async def roundtrip():
+            left_sock, right_sock = socket.socketpair()
+            left = common.StreamChannel(*await asyncio.open_unix_connection(sock=left_sock))
+            right = common.StreamChannel(*await asyncio.open_unix_connection(sock=right_sock))
+            received = []
+            right.on('message', received.append)
+            left.emit('open')
+            right.emit('open')
+            reading = asyncio.ensure_future(right.receive_forever())
+            left.send(pickle.dumps(np.array((100, 100))))
+            left.send(b'')
+            left.close()
+            await reading
+            return received
+
+        received = asyncio.run(roundtrip())
+        self.assertEqual(len(received), 2, 'Both messages should arrive intact.')
+        self.assertTrue((pickle.loads(received[0]) == (100, 100)).all())
+        self.assertEqual(received[1], b'')
+
+    def test_streamChannelBackedUp(self):
+        async def send_backed_up():
+            left_sock, right_sock = socket.socketpair()
+            left_sock.setblocking(False)
+            right_sock.setblocking(False)
+            reader, writer = await asyncio.open_unix_connection(sock=left_sock)
+            channel = common.StreamChannel(reader, writer)
+            channel.emit('open')
+            frame = bytes(channel.MAX_BUFFERED)
+            # nobody reads the other end: the socket buffer fills up, then the writer's
+            for _ in range(64):
+                channel.send(frame)
+            buffered = writer.transport.get_write_buffer_size()
+            channel.close()
+            right_sock.close()
+            return channel.dropped, buffered
+
+        dropped, buffered = asyncio.run(send_backed_up())
+        self.assertGreater(dropped, 0, 'Messages should be skipped while the peer is not reading.')
+        self.assertLessEqual(buffered, 2 * common.StreamChannel.MAX_BUFFERED + 4,
+                             'The write buffer should stay bounded.')
+
+
+if __name__ == '__main__':
+    unittest.main()